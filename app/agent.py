@@ -1,6 +1,7 @@
 # run_gradio_agent.py
+import asyncio
 import os
-import gradio as gr
+from typing import TYPE_CHECKING
 
 from dotenv import load_dotenv
 
@@ -8,43 +9,61 @@ from config import settings
 from app.main import FileSystemAgent, AgentConfig, ModelProvider
 from app.utils.logging import logger
 
+if TYPE_CHECKING:
+    import gradio as gr
+
 
 _agent_holder: dict[str, FileSystemAgent | None] = {'agent': None}
+# обработчики идут параллельно — инициализирует агента только один из них
+_startup_lock = asyncio.Lock()
+
+# обработчики асинхронные (I/O: LLM + HTTP), поэтому параллельные
+# запросы не упираются в GIL и не занимают пул потоков
+CONCURRENCY_LIMIT = int(os.getenv('GRADIO_CONCURRENCY_LIMIT', '8'))
 
 
 async def _startup():
     if _agent_holder['agent'] and _agent_holder['agent'].is_ready:
         return '✅ Агент уже инициализирован'
 
-    load_dotenv()
-    cfg = AgentConfig(
-        filesystem_path=settings.FILESYSTEM_PATH,
-        model_provider=ModelProvider(settings.MODEL_PROVIDER),
-        enable_web_search=True
-    )
-    agent = FileSystemAgent(cfg)
-    ok = await agent.initialize()
-    if not ok:
-        logger.error('❌ Не удалось инициализировать агента')
-        return '❌ Не удалось инициализировать агента'
-    _agent_holder['agent'] = agent
-    logger.info('✅ Агент готов (Gradio)')
-    return '✅ Агент готов'
-
-
-# --- Обработчик сообщений чата (асинхронный) ---
-async def chat_handler(message: str, history: list[dict]):
+    async with _startup_lock:
+        # пока ждали блокировку, агента мог поднять другой обработчик
+        if _agent_holder['agent'] and _agent_holder['agent'].is_ready:
+            return '✅ Агент уже инициализирован'
+
+        load_dotenv()
+        cfg = AgentConfig(
+            filesystem_path=settings.FILESYSTEM_PATH,
+            model_provider=ModelProvider(settings.MODEL_PROVIDER),
+            enable_web_search=True
+        )
+        agent = FileSystemAgent(cfg)
+        ok = await agent.initialize()
+        if not ok:
+            logger.error('❌ Не удалось инициализировать агента')
+            return '❌ Не удалось инициализировать агента'
+        _agent_holder['agent'] = agent
+        logger.info('✅ Агент готов (Gradio)')
+        return '✅ Агент готов'
+
+
+# --- Обработчик сообщений чата (асинхронный, потоковый) ---
+async def chat_handler(
+    message: str,
+    history: list[dict],
+    thread_id: str = 'gradio'
+):
     if not _agent_holder['agent'] or not _agent_holder['agent'].is_ready:
         init_msg = await _startup()
         logger.info(init_msg)
 
     agent = _agent_holder['agent']
     try:
-        reply = await agent.process_message(message, thread_id='gradio')
-        return reply
+        async for chunk in agent.astream_message(message, thread_id=thread_id):
+            yield chunk
     except Exception as e:
         logger.error(f'❌ Ошибка обработки: {e}')
-        return (
+        yield (
             '❌ Не удалось сгенерировать ответ. '
             'Попробуйте ещё раз или проверьте логи.'
         )
@@ -71,7 +90,10 @@ async def get_status():
 
 
 # --- Сборка Gradio UI ---
-def build_app() -> gr.Blocks:
+def build_app() -> 'gr.Blocks':
+    # gradio тяжёлый — импортируем только при сборке UI
+    import gradio as gr
+
     with gr.Blocks(title='Web Search Agent', theme='soft') as demo:
         header = gr.Markdown('# 🔍 Web Search Agent')
         sub = gr.Markdown(
@@ -99,16 +121,33 @@ def build_app() -> gr.Blocks:
         demo.load(_startup, inputs=None, outputs=init_status)
 
         # обработка отправки
-        async def _on_send(user_text, history):
-            reply = await chat_handler(user_text, history or [])
+        async def _on_send(user_text, history, request: gr.Request):
             new_history = (history or []) + [
                 {'role': 'user', 'content': user_text},
-                {'role': 'assistant', 'content': reply},
+                {'role': 'assistant', 'content': ''},
             ]
-            return '', new_history
-
-        send.click(_on_send, inputs=[msg, chat], outputs=[msg, chat])
-        msg.submit(_on_send, inputs=[msg, chat], outputs=[msg, chat])
+            yield '', new_history
+            # у каждой сессии браузера своя память агента
+            thread_id = f'gradio_{request.session_hash}'
+            # дописываем ответ по мере генерации
+            async for chunk in chat_handler(
+                user_text, history or [], thread_id
+            ):
+                new_history[-1]['content'] += chunk
+                yield '', new_history
+
+        send.click(
+            _on_send,
+            inputs=[msg, chat],
+            outputs=[msg, chat],
+            concurrency_limit=CONCURRENCY_LIMIT,
+        )
+        msg.submit(
+            _on_send,
+            inputs=[msg, chat],
+            outputs=[msg, chat],
+            concurrency_limit=CONCURRENCY_LIMIT,
+        )
 
         # очистка чата
         def _clear_chat():
@@ -125,8 +164,8 @@ def build_app() -> gr.Blocks:
 if __name__ == '__main__':
     port = int(os.getenv('PORT', '7860'))
     app = build_app()
-    # просто включаем очередь
-    app.queue().launch(
+    # очередь с параллельной обработкой запросов
+    app.queue(default_concurrency_limit=CONCURRENCY_LIMIT).launch(
         server_name='0.0.0.0',
         server_port=port,
         show_error=True
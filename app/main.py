@@ -1,22 +1,33 @@
 import asyncio
 import os
+import random
 from enum import Enum
 from functools import wraps
-from typing import Optional, Dict, Any
-from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import AsyncIterator, Optional, Dict, Any, Mapping
+from dataclasses import dataclass
+from datetime import date
 
+from aioconsole import ainput
 from dotenv import load_dotenv
-from langchain_ollama import ChatOllama
-from langchain_openai import ChatOpenAI
-from langchain_deepseek import ChatDeepSeek
-from langchain_mcp_adapters.client import MultiServerMCPClient
-from langchain_core.messages import HumanMessage
+from langchain_core.messages import (
+    AIMessageChunk,
+    AnyMessage,
+    HumanMessage,
+    SystemMessage,
+)
 from langgraph.prebuilt import create_react_agent
 from langgraph.checkpoint.memory import InMemorySaver
 
 from config import settings
 from app.utils.logging import logger
-from app.utils.tools import SearchLoggingCallback, wrap_search_tool
+from app.utils.tools import (
+    SearchLoggingCallback,
+    SearchTurn,
+    classify_tool,
+    current_search_turn,
+    wrap_search_tool,
+)
 
 
 # ===== ЕНУМЫ И КОНСТАНТЫ =====
@@ -29,31 +40,86 @@ class ModelProvider(Enum):
 
 
 # ===== ДЕКОРАТОРЫ =====
-def retry_on_failure(max_retries: int = 2, delay: float = 1.0):
-    """Декоратор для повторения операций при неудаче"""
+def _is_retryable(e: Exception) -> bool:
+    """Повторять ли операцию после такой ошибки"""
+    # ошибки в данных/конфигурации повтором не исправить
+    if isinstance(e, (ValueError, KeyError)):
+        return False
+    # HTTP 4xx (кроме 429) — постоянная ошибка запроса
+    status = getattr(e, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(e, 'response', None), 'status_code', None)
+    if isinstance(status, int) and 400 <= status < 500 and status != 429:
+        return False
+    return True
+
+
+def retry_on_failure(
+    max_retries: int = 2,
+    delay: float = 1.0,
+    max_delay: float = 30.0,
+):
+    """Декоратор для повторения операций при неудаче
+
+    Пауза растёт экспоненциально (delay * 2**attempt, не больше max_delay)
+    со случайным разбросом в половину паузы; постоянные ошибки
+    пробрасываются сразу.
+    """
 
     def decorator(func):
         @wraps(func)
         async def wrapper(*args, **kwargs):
-            last_exception = None
             for attempt in range(max_retries):
                 try:
                     return await func(*args, **kwargs)
                 except Exception as e:
-                    last_exception = e
-                    if attempt < max_retries - 1:
-                        logger.warning(
-                            f'Попытка {attempt + 1} неудачна, '
-                            f'повтор через {delay}с'
-                            )
-                        await asyncio.sleep(delay)
-            raise last_exception
+                    if attempt >= max_retries - 1 or not _is_retryable(e):
+                        raise
+                    pause = min(delay * 2 ** attempt, max_delay)
+                    pause *= 0.5 + random.random() * 0.5
+                    logger.warning(
+                        'Попытка {} неудачна ({}), повтор через {:.1f}с',
+                        attempt + 1,
+                        e,
+                        pause,
+                    )
+                    await asyncio.sleep(pause)
         return wrapper
     return decorator
 
 
 # ===== УПРОЩЕННАЯ КОНФИГУРАЦИЯ =====
-@dataclass
+# Упрощенные настройки моделей (общие и неизменяемые)
+MODEL_CONFIGS: Mapping[str, Mapping[str, Any]] = MappingProxyType({
+    'ollama': MappingProxyType({
+        'model_name': 'qwen2.5:0.5b',
+        'base_url': 'http://localhost:11434',
+        'temperature': settings.TEMPERATURE,
+        'answer_max_tokens': settings.ANSWER_MAX_TOKENS,
+    }),
+    'openrouter': MappingProxyType({
+        'model_name': 'moonshotai/kimi-k2:free',
+        'api_key_env': 'OPENROUTER_API_KEY',
+        'base_url': 'https://openrouter.ai/api/v1',
+        'temperature': settings.TEMPERATURE,
+        'answer_max_tokens': settings.ANSWER_MAX_TOKENS,
+    }),
+    'openai': MappingProxyType({
+        'model_name': 'gpt-4o-mini',
+        'api_key_env': 'OPENAI_API_KEY',
+        'temperature': settings.TEMPERATURE,
+        'answer_max_tokens': settings.ANSWER_MAX_TOKENS,
+    }),
+    'deepseek': MappingProxyType({
+        'model_name': 'deepseek-chat',
+        'api_key_env': 'DEEPSEEK_API_KEY',
+        'temperature': settings.TEMPERATURE,
+        'answer_max_tokens': settings.ANSWER_MAX_TOKENS,
+    }),
+})
+
+
+@dataclass(slots=True)
 class AgentConfig:
     """Упрощенная конфигурация AI-агента"""
     filesystem_path: str = '/Users/alexeyfilichkin/MainDev/web_search_agent'
@@ -61,41 +127,12 @@ class AgentConfig:
     use_memory: bool = True
     enable_web_search: bool = True
 
-    # Упрощенные настройки моделей
-    model_configs: Dict[str, Dict[str, Any]] = field(default_factory=lambda: {
-        'ollama': {
-            'model_name': 'qwen2.5:0.5b',
-            'base_url': 'http://localhost:11434',
-            'temperature': settings.TEMPERATURE,
-            'answer_max_tokens': settings.ANSWER_MAX_TOKENS,
-        },
-        'openrouter': {
-            'model_name': 'moonshotai/kimi-k2:free',
-            'api_key_env': 'OPENROUTER_API_KEY',
-            'base_url': 'https://openrouter.ai/api/v1',
-            'temperature': settings.TEMPERATURE,
-            'answer_max_tokens': settings.ANSWER_MAX_TOKENS,
-        },
-        'openai': {
-            'model_name': 'gpt-4o-mini',
-            'api_key_env': 'OPENAI_API_KEY',
-            'temperature': settings.TEMPERATURE,
-            'answer_max_tokens': settings.ANSWER_MAX_TOKENS,
-        },
-        'deepseek': {
-            'model_name': 'deepseek-chat',
-            'api_key_env': 'DEEPSEEK_API_KEY',
-            'temperature': settings.TEMPERATURE,
-            'answer_max_tokens': settings.ANSWER_MAX_TOKENS,
-        }
-    })
-
     def validate(self) -> None:
         """Валидация конфигурации"""
         if not os.path.exists(self.filesystem_path):
             raise ValueError(f'Путь не существует: {self.filesystem_path}')
 
-        config = self.model_configs.get(self.model_provider.value)
+        config = MODEL_CONFIGS.get(self.model_provider.value)
         if not config:
             raise ValueError(
                 f'Неподдерживаемый провайдер: {self.model_provider}'
@@ -161,13 +198,15 @@ class ModelFactory:
     def create_model(config: AgentConfig):
         """Создает модель согласно конфигурации"""
         provider = config.model_provider.value
-        model_config = config.model_configs[provider]
+        model_config = MODEL_CONFIGS[provider]
 
         logger.info(
             f'Создание модели {provider}: {model_config["model_name"]}'
             )
 
+        # SDK провайдеров тяжёлые — импортируем только нужный
         if provider == 'ollama':
+            from langchain_ollama import ChatOllama
             return ChatOllama(
                 model=model_config['model_name'],
                 base_url=model_config['base_url'],
@@ -178,6 +217,7 @@ class ModelFactory:
             )
 
         elif provider in ['openrouter', 'openai']:
+            from langchain_openai import ChatOpenAI
             api_key = settings.OPENAI_API_KEY
             return ChatOpenAI(
                 model=model_config['model_name'],
@@ -189,6 +229,7 @@ class ModelFactory:
                 max_retries=6
             )
         elif provider == 'deepseek':
+            from langchain_deepseek import ChatDeepSeek
             api_key = os.getenv(model_config['api_key_env'])
             return ChatDeepSeek(
                 model=model_config['model_name'],
@@ -213,7 +254,11 @@ class FileSystemAgent:
         self.mcp_client = None
         self.tools = []
         self._initialized = False
-        self._last_user_input = None
+        self._system_prompt: Optional[str] = None
+        self._prompt_date: Optional[date] = None
+        self._mcp_config: Optional[Dict[str, Any]] = None
+        # колбэк без состояния — один на агента для всех сообщений
+        self._search_cb = SearchLoggingCallback()
 
         logger.info(
             f'Создан агент с провайдером: {config.model_provider.value}'
@@ -221,6 +266,13 @@ class FileSystemAgent:
         if config.enable_web_search:
             logger.info('Веб-поиск включен')
 
+    @property
+    def mcp_config(self) -> Dict[str, Any]:
+        """Конфигурация MCP серверов (собирается один раз на агента)"""
+        if self._mcp_config is None:
+            self._mcp_config = self.config.get_mcp_config()
+        return self._mcp_config
+
     @property
     def is_ready(self) -> bool:
         """Проверяет готовность агента"""
@@ -254,7 +306,7 @@ class FileSystemAgent:
                 model=model,
                 tools=self.tools,
                 checkpointer=self.checkpointer,
-                prompt=self._get_system_prompt()
+                prompt=self._build_prompt
             )
 
             self._initialized = True
@@ -269,35 +321,30 @@ class FileSystemAgent:
     async def _init_mcp_client(self):
         """Инициализация MCP клиента"""
 
+        from langchain_mcp_adapters.client import MultiServerMCPClient
+
         logger.info('Инициализация MCP клиента...')
-        self.mcp_client = MultiServerMCPClient(self.config.get_mcp_config())
+        self.mcp_client = MultiServerMCPClient(self.mcp_config)
 
         orig_tools = await self.mcp_client.get_tools()
         if not orig_tools:
             raise Exception('Нет доступных MCP инструментов')
 
-        def _get_raw():
-            return getattr(self, '_last_user_input', None)
-
         self.tools = []
-        filesystem_tools = []
-        search_tools = []
+        # имена инструментов по категориям (только для лога)
+        names_by_category: Dict[str, list[str]] = {'fs': [], 'search': []}
 
         for tool in orig_tools:
-            name = (tool.name or '').lower()
-            if any(k in name for k in ['search', 'brave', 'web']):
-                # оборачиваем ТОЛЬКО инструменты поиска
-                wrapped = wrap_search_tool(tool, _get_raw)
-                self.tools.append(wrapped)
-                search_tools.append(tool.name)
-            else:
-                # все остальные — без изменений
-                self.tools.append(tool)
-                if any(
-                    fs_keyword in name for fs_keyword
-                    in ['read', 'write', 'file', 'directory', 'move', 'create']
-                ):
-                    filesystem_tools.append(tool.name)
+            category = classify_tool(tool.name)
+            # оборачиваем ТОЛЬКО инструменты поиска, остальные — без изменений
+            self.tools.append(
+                wrap_search_tool(tool) if category == 'search' else tool
+            )
+            if category is not None:
+                names_by_category[category].append(tool.name)
+
+        filesystem_tools = names_by_category['fs']
+        search_tools = names_by_category['search']
 
         logger.info(f'Загружено {len(self.tools)} инструментов:')
 
@@ -318,7 +365,20 @@ class FileSystemAgent:
                 '⚠️ Веб-поиск включен, но инструменты поиска не загружены'
                 )
 
-    def _get_system_prompt(self) -> str:
+    @property
+    def system_prompt(self) -> str:
+        """Системный промпт, собранный один раз за день (в нём дата)"""
+        today = date.today()
+        if self._system_prompt is None or self._prompt_date != today:
+            self._system_prompt = self._get_system_prompt(today)
+            self._prompt_date = today
+        return self._system_prompt
+
+    def _build_prompt(self, state: Dict[str, Any]) -> list[AnyMessage]:
+        """Промпт для create_react_agent: системное сообщение + история"""
+        return [SystemMessage(content=self.system_prompt), *state['messages']]
+
+    def _get_system_prompt(self, today: date) -> str:
         """Формирует системный промпт для агента,
         объясняющий его задачи и поведение"""
         base_prompt = (
@@ -343,8 +403,7 @@ class FileSystemAgent:
                 'для получения нужных сведений.'
                 )
 
-        import datetime
-        today_str = datetime.datetime.now().strftime('%d %B %Y')
+        today_str = today.strftime('%d %B %Y')
         base_prompt += (
             ' Всегда внимательно анализируй запрос пользователя и выбирай '
             'наиболее подходящий инструмент для выполнения задачи.'
@@ -380,13 +439,8 @@ class FileSystemAgent:
             return '❌ Агент не готов. Попробуйте переинициализировать.'
 
         try:
-            self._last_user_input = user_input
-            config = {
-                'configurable': {'thread_id': thread_id},
-                'raw_user_input': user_input,
-                'callbacks': [SearchLoggingCallback()],
-                'recursion_limit': 8
-                }
+            current_search_turn.set(SearchTurn(user_input))
+            config = self._get_run_config(user_input, thread_id)
             message_input = {'messages': [HumanMessage(content=user_input)]}
             response = await self.agent.ainvoke(message_input, config)
             return response['messages'][-1].content
@@ -416,9 +470,60 @@ class FileSystemAgent:
                 pass
             return (
                 '❌ Не удалось сгенерировать финальный ответ (сетевой сбой). '
-                'Источники сохранены в results.json.'
+                'Источники сохранены в results.jsonl.'
                 )
 
+    async def astream_message(
+        self,
+        user_input: str,
+        thread_id: str = 'default'
+    ) -> AsyncIterator[str]:
+        """Потоковая обработка сообщения: отдаёт ответ модели по частям"""
+        if not self.is_ready:
+            yield '❌ Агент не готов. Попробуйте переинициализировать.'
+            return
+
+        current_search_turn.set(SearchTurn(user_input))
+        config = self._get_run_config(user_input, thread_id)
+        message_input = {'messages': [HumanMessage(content=user_input)]}
+        streamed = False
+        try:
+            async for chunk, metadata in self.agent.astream(
+                message_input, config, stream_mode='messages'
+            ):
+                # только токены модели, без вывода инструментов
+                if metadata.get('langgraph_node') != 'agent':
+                    continue
+                if (
+                    isinstance(chunk, AIMessageChunk)
+                    and isinstance(chunk.content, str)
+                    and chunk.content
+                ):
+                    streamed = True
+                    yield chunk.content
+        except Exception as e:
+            logger.error(f'❌ Ошибка обработки: {e}')
+            if streamed:
+                yield '\n\n_Генерация прервана из-за ошибки._'
+            else:
+                yield (
+                    '❌ Не удалось сгенерировать финальный ответ '
+                    '(сетевой сбой). Источники сохранены в results.jsonl.'
+                )
+
+    def _get_run_config(
+        self,
+        user_input: str,
+        thread_id: str
+    ) -> Dict[str, Any]:
+        """Конфигурация запуска графа для одного сообщения"""
+        return {
+            'configurable': {'thread_id': thread_id},
+            'raw_user_input': user_input,
+            'callbacks': [self._search_cb],
+            'recursion_limit': settings.RECURSION_LIMIT
+            }
+
     def get_status(self) -> Dict[str, Any]:
         """Информация о состоянии агента"""
         return {
@@ -440,15 +545,16 @@ class InteractiveChat:
         self.agent = agent
         self.thread_id = 'main'
 
-    def get_user_input(self) -> Optional[str]:
+    async def get_user_input(self) -> Optional[str]:
         """Получение ввода пользователя"""
         try:
-            user_input = input('\n> ').strip()
+            # ainput читает stdin через event loop, не блокируя его
+            user_input = (await ainput('\n> ')).strip()
 
             if user_input.lower() in ['quit', 'exit', 'выход']:
                 return None
             elif user_input.lower() == 'clear':
-                self.thread_id = f'thread_{asyncio.get_event_loop().time()}'
+                self.thread_id = f'thread_{asyncio.get_running_loop().time()}'
                 print('💭 История очищена')
                 return ''
             elif user_input.lower() == 'status':
@@ -462,7 +568,8 @@ class InteractiveChat:
 
             return user_input
 
-        except (KeyboardInterrupt, EOFError):
+        # Ctrl+C во время ожидания ввода отменяет задачу — это выход
+        except (KeyboardInterrupt, EOFError, asyncio.CancelledError):
             return None
 
     async def run(self):
@@ -486,7 +593,7 @@ class InteractiveChat:
                   )
 
         while True:
-            user_input = self.get_user_input()
+            user_input = await self.get_user_input()
 
             if user_input is None:
                 break
@@ -0,0 +1,46 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+import xxhash
+
+
+def fingerprint(text: str) -> int:
+    '''
+    64-битный отпечаток строки (xxh64). Множества отпечатков хранят
+    int фиксированного размера вместо полных строк.
+    '''
+    return xxhash.xxh64_intdigest(text.encode('utf-8'))
+
+
+class TTLCache:
+    '''
+    Простой in-process LRU-кэш с ограничением по размеру
+    и времени жизни записей (TTL, в секундах).
+    '''
+
+    def __init__(self, max_items: int, ttl: float):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return default
+        stored_at, value = item
+        if time.monotonic() - stored_at >= self.ttl:
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+        # вытесняем самые старые записи
+        while len(self._data) > self.max_items:
+            self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -1,3 +1,17 @@
 MAX_ITEMS = 5
 SNIPPET_MAX_CHARS = 1500
 TRANFILATURA_MAX_CHARS = 2000
+DESC_CACHE_MAX_ITEMS = 512
+DESC_CACHE_TTL = 3600
+SEARCH_CACHE_MAX_ITEMS = 1000
+SEARCH_CACHE_TTL = 1800
+CONTEXT_CACHE_MAX_ITEMS = 128
+# верхняя граница пула процессов Trafilatura (фактически — не больше ядер)
+EXTRACT_WORKERS = 4
+RICH_DESC_MIN_CHARS = 500
+FETCH_CONCURRENCY = 8
+HTML_MAX_BYTES = 256 * 1024
+DESC_DISK_CACHE_DIR = '.cache/desc'
+DESC_DISK_CACHE_TTL = 86400
+DESC_DISK_CACHE_SIZE_LIMIT = 2 ** 30
+DESC_DISK_CACHE_WORKERS = 2
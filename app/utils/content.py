@@ -1,51 +1,322 @@
+import asyncio
+import atexit
+import functools
+import os
 import re
-import trafilatura
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
 
-from app.utils.constants import TRANFILATURA_MAX_CHARS
+import httpx
+from diskcache import Cache
+
+try:
+    from selectolax.parser import HTMLParser
+except ImportError:
+    # без selectolax теги вырезаются регуляркой
+    HTMLParser = None
+
+from app.utils.cache import TTLCache
+from app.utils.constants import (
+    DESC_CACHE_MAX_ITEMS,
+    DESC_CACHE_TTL,
+    DESC_DISK_CACHE_DIR,
+    DESC_DISK_CACHE_SIZE_LIMIT,
+    DESC_DISK_CACHE_TTL,
+    DESC_DISK_CACHE_WORKERS,
+    EXTRACT_WORKERS,
+    FETCH_CONCURRENCY,
+    HTML_MAX_BYTES,
+    TRANFILATURA_MAX_CHARS,
+)
 from app.utils.logging import logger
+from app.utils.urls import normalize_url
 
 
 _HTML_TAG_RE = re.compile(r'<[^>]+>')
 
+# антибот-заглушки проверяем по началу HTML, до извлечения текста;
+# 'captcha' ищем только в <title>: скрипты reCAPTCHA есть и на обычных
+# страницах с формами
+_CAPTCHA_SCAN_BYTES = 16384
+# регистр игнорирует сам regex — без копий страницы через .lower()
+_CAPTCHA_RU_RE = re.compile(
+    r'подтвердите,\s*что\s*запросы\s*отправляли\s*вы', re.I
+)
+_CAPTCHA_TITLE_RE = re.compile(rb'captcha', re.I)
+_TITLE_RE = re.compile(rb'<title[^>]*>(.*?)</title>', re.I | re.S)
+
+_HTTP_CLIENT: Optional[httpx.AsyncClient] = None
+_HTTP_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (compatible; web-search-agent/1.0)',
+}
+
+# общий предел одновременных загрузок для всех поисков и сессий
+_FETCH_SEMAPHORE = asyncio.Semaphore(FETCH_CONCURRENCY)
+
+# extract — CPU и GIL, поэтому разбор HTML идёт в отдельных процессах
+_EXTRACT_POOL: Optional[ProcessPoolExecutor] = None
+
+# кэш извлечённого текста по URL (без fallback — он свой у каждого вызова):
+# в памяти процесса и на диске (переживает перезапуск)
+_DESC_CACHE = TTLCache(DESC_CACHE_MAX_ITEMS, DESC_CACHE_TTL)
+_DISK_CACHE: Optional[Cache] = None
+# свой небольшой пул для SQLite-запросов diskcache, чтобы не делить
+# пул asyncio по умолчанию с сохранениями и вводом консоли
+_DISK_POOL = ThreadPoolExecutor(
+    max_workers=DESC_DISK_CACHE_WORKERS,
+    thread_name_prefix='desc-cache',
+)
+
+# сколько раз страница не загружалась, т.к. описания из поиска хватило
+_RICH_FALLBACK_HITS = 0
+
+# загрузки в процессе: одновременные запросы одного URL ждут одну задачу
+_INFLIGHT: dict[str, asyncio.Task] = {}
+
+
+def _get_http_client() -> httpx.AsyncClient:
+    """Общий HTTP-клиент с пулом соединений (создаётся лениво)."""
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is None or _HTTP_CLIENT.is_closed:
+        _HTTP_CLIENT = httpx.AsyncClient(
+            headers=_HTTP_HEADERS,
+            follow_redirects=True,
+            timeout=httpx.Timeout(10.0, connect=3.0),
+            # держим keep-alive соединения, чтобы не повторять TCP+TLS
+            limits=httpx.Limits(
+                max_connections=20,
+                max_keepalive_connections=20,
+                keepalive_expiry=30.0,
+            ),
+        )
+    return _HTTP_CLIENT
+
+
+def _get_extract_pool() -> ProcessPoolExecutor:
+    """Пул процессов для Trafilatura (создаётся лениво)."""
+    global _EXTRACT_POOL
+    if _EXTRACT_POOL is None:
+        # извлечение упирается в CPU — больше процессов, чем ядер, не нужно
+        workers = min(os.cpu_count() or 1, EXTRACT_WORKERS)
+        _EXTRACT_POOL = ProcessPoolExecutor(max_workers=workers)
+    return _EXTRACT_POOL
+
+
+@atexit.register
+def _shutdown_extract_pool() -> None:
+    """Останавливает пул процессов при выходе, не дожидаясь очереди."""
+    if _EXTRACT_POOL is not None:
+        _EXTRACT_POOL.shutdown(wait=False, cancel_futures=True)
+
+
+def _collapse_ws(s: str) -> str:
+    # split() без аргументов схлопывает любые пробельные символы за один
+    # проход на C и сразу отбрасывает их по краям
+    return ' '.join(s.split())
+
 
 def _clean_text(s: str) -> str:
-    s = s or ''
-    s = _HTML_TAG_RE.sub('', s)
-    s = re.sub(r'\s+', ' ', s).strip()
-    return s
+    """Очистка description из поиска: HTML-теги и лишние пробелы."""
+    if not s:
+        return ''
+    # обычный текст (частый случай) в HTML-парсер не отправляем
+    if '<' in s:
+        if HTMLParser is not None:
+            s = HTMLParser(s).text(separator='')
+        else:
+            s = _HTML_TAG_RE.sub('', s)
+    return _collapse_ws(s)
 
 
-def fetch_desc_trafilatura(
-        url: str,
-        fallback_text: str = '',
-        max_chars: int = TRANFILATURA_MAX_CHARS
-) -> str:
+@functools.lru_cache(maxsize=None)
+def _trafilatura():
+    """Ленивый импорт Trafilatura: модуль тяжёлый, нужен только при поиске."""
+    import trafilatura
+    return trafilatura
+
+
+def _extract_worker(html: bytes, url: str, max_chars: int) -> str:
+    """Выполняется в процессе пула: извлечение, очистка и обрезка текста."""
+    txt = _trafilatura().extract(
+        html,
+        url=url,
+        output_format='txt',
+        include_comments=False,
+        include_tables=False,
+        include_formatting=False,
+        deduplicate=False,
+        # без запасных экстракторов (readability/justext) — текст всё
+        # равно обрезается до max_chars
+        fast=True,
+    )
+    # txt — уже извлечённый текст с раскодированными сущностями:
+    # '<' в нём — это код или сравнение, а не тег, HTML-парсер его обрежет
+    return _collapse_ws(txt)[:max_chars] if txt else ''
+
+
+def _looks_like_captcha(html: bytes) -> bool:
+    """Дешёвая проверка начала страницы на антибот-заглушку."""
+    head = html[:_CAPTCHA_SCAN_BYTES]
+    title = _TITLE_RE.search(head)
+    if title and _CAPTCHA_TITLE_RE.search(title.group(1)):
+        return True
+    text = head.decode('utf-8', errors='ignore')
+    return _CAPTCHA_RU_RE.search(text) is not None
+
+
+def _cache_key(url: str, max_chars: int) -> str:
+    # текст обрезается по max_chars — разные лимиты кэшируем раздельно
+    return f'{max_chars}:{normalize_url(url)}'
+
+
+def _get_disk_cache() -> Cache:
+    """Дисковый кэш описаний (создаётся лениво)."""
+    global _DISK_CACHE
+    if _DISK_CACHE is None:
+        _DISK_CACHE = Cache(
+            DESC_DISK_CACHE_DIR,
+            size_limit=DESC_DISK_CACHE_SIZE_LIMIT,
+        )
+    return _DISK_CACHE
+
+
+async def _cache_get(key: str) -> Optional[str]:
+    extracted = _DESC_CACHE.get(key)
+    if extracted is not None:
+        return extracted
+    try:
+        # SQLite-запрос уносим с event loop
+        extracted = await asyncio.get_running_loop().run_in_executor(
+            _DISK_POOL, _get_disk_cache().get, key
+        )
+    except Exception as e:
+        logger.warning('[Trafilatura] дисковый кэш недоступен: {}', e)
+        return None
+    if extracted is not None:
+        _DESC_CACHE.set(key, extracted)
+    return extracted
+
+
+async def _cache_set(key: str, extracted: str) -> None:
+    _DESC_CACHE.set(key, extracted)
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            _DISK_POOL,
+            functools.partial(
+                _get_disk_cache().set,
+                key,
+                extracted,
+                expire=DESC_DISK_CACHE_TTL,
+            ),
+        )
+    except Exception as e:
+        logger.warning('[Trafilatura] дисковый кэш недоступен: {}', e)
+
+
+async def _download(url: str, max_bytes: int = HTML_MAX_BYTES) -> bytes:
     """
-    Пытается извлечь краткое описание страницы через Trafilatura.
-    Если не удалось (пусто), возвращает fallback_text (очищенный).
+    Скачивает страницу потоком и обрывает чтение после max_bytes:
+    для сниппета в пару тысяч символов хватает начала документа.
     """
-    extracted = ''
+    chunks = []
+    size = 0
+    async with _get_http_client().stream('GET', url) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes(65536):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= max_bytes:
+                break
+    return b''.join(chunks)[:max_bytes]
+
 
+async def _extract_page(url: str, max_chars: int) -> str:
+    """Скачивает страницу и извлекает из неё текст через Trafilatura."""
+    global _EXTRACT_POOL
     try:
-        logger.info(f'[Trafilatura] fetch url: {url}')
-        html = trafilatura.fetch_url(url)
+        logger.info('[Trafilatura] fetch url: {}', url)
+        async with _FETCH_SEMAPHORE:
+            html = await _download(url)
+        if _looks_like_captcha(html):
+            logger.warning('[Trafilatura] страница-капча, пропуск: {}', url)
+            return ''
         if html:
-            txt = trafilatura.extract(
+            # между процессами передаём только байты HTML и готовый текст
+            return await asyncio.get_running_loop().run_in_executor(
+                _get_extract_pool(),
+                _extract_worker,
                 html,
-                url=url,
-                output_format='txt',
-                include_comments=False,
-                include_tables=False,
-                favor_recall=True,
+                url,
+                max_chars,
             )
-            extracted = _clean_text(txt)[:max_chars] if txt else ''
+    except BrokenProcessPool as e:
+        _EXTRACT_POOL = None
+        logger.warning('[Trafilatura] пул процессов упал, пересоздаём: {}', e)
     except Exception as e:
-        logger.warning(f'[Trafilatura] исключение при извлечении: {e}')
+        logger.warning('[Trafilatura] исключение при извлечении: {}', e)
+    return ''
+
+
+async def _extract_page_once(key: str, url: str, max_chars: int) -> str:
+    """Склеивает одновременные извлечения одного URL в одну загрузку."""
+    task = _INFLIGHT.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_extract_page(url, max_chars))
+        _INFLIGHT[key] = task
+        task.add_done_callback(lambda _: _INFLIGHT.pop(key, None))
+    else:
+        logger.info('[Trafilatura] ждём уже идущую загрузку: {}', url)
+    # отмена одного ожидающего не должна отменять загрузку для остальных
+    return await asyncio.shield(task)
+
+
+def _looks_truncated(text: str) -> bool:
+    return text.endswith(('...', '…'))
+
+
+async def fetch_desc_trafilatura(
+        url: str,
+        fallback_text: str = '',
+        max_chars: int = TRANFILATURA_MAX_CHARS,
+        rich_fallback_chars: int = 0
+) -> str:
+    """
+    Пытается извлечь краткое описание страницы через Trafilatura.
+    Если не удалось (пусто), возвращает fallback_text (очищенный).
+    Если rich_fallback_chars > 0 и fallback_text не короче этого порога
+    (и не обрезан), страница не загружается вовсе.
+    Успешные извлечения кэшируются по (URL, max_chars): LRU + TTL
+    в памяти и diskcache на диске.
+    """
+    global _RICH_FALLBACK_HITS
+    if rich_fallback_chars > 0:
+        cleaned = _clean_text(fallback_text)
+        if (
+            len(cleaned) >= rich_fallback_chars
+            and not _looks_truncated(cleaned)
+        ):
+            _RICH_FALLBACK_HITS += 1
+            logger.info(
+                '[Trafilatura] описание достаточное, загрузка пропущена '
+                '({} симв., всего пропусков: {}): {}',
+                len(cleaned), _RICH_FALLBACK_HITS, url
+            )
+            return cleaned[:max_chars]
+
+    key = _cache_key(url, max_chars)
+    extracted = await _cache_get(key)
+    if extracted is not None:
+        logger.info('[Trafilatura] cache hit: {}', url)
+    else:
+        extracted = await _extract_page_once(key, url, max_chars)
+        if extracted:
+            await _cache_set(key, extracted)
 
     if extracted:
-        snippet = extracted[:200]
         logger.info(
-            f'[Trafilatura] OK ({len(extracted)} симв.): "{snippet}..."'
+            '[Trafilatura] OK ({} симв.): "{}..."',
+            len(extracted), extracted[:200]
             )
         return extracted
 
@@ -53,7 +324,8 @@ def fetch_desc_trafilatura(
     fallback_text = _clean_text(fallback_text)[:max_chars]
     if fallback_text:
         logger.info(
-            f'[Trafilatura] fallback использован ({len(fallback_text)} симв.)'
+            '[Trafilatura] fallback использован ({} симв.)',
+            len(fallback_text)
             )
     else:
         logger.warning('[Trafilatura] fallback пуст')
@@ -6,6 +6,9 @@ from loguru import logger
 # убираем дефолтные хендлеры (чтобы не дублировался вывод)
 logger.remove()
 
+# enqueue=True: запись в stdout и файл (с ротацией и архивацией) идёт
+# в фоновом потоке loguru, event loop только кладёт запись в очередь
+
 # вывод в stdout
 logger.add(
     sys.stdout,
@@ -13,7 +16,8 @@ logger.add(
            '<level>{level: <8}</level> | '
            '<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - '
            '<level>{message}</level>',
-    level='INFO'
+    level='INFO',
+    enqueue=True
 )
 
 # вывод в файл с ротацией
@@ -23,5 +27,6 @@ logger.add(
     retention='7 days',   # хранить неделю
     compression='zip',    # архивировать старые логи
     level='DEBUG',
-    encoding='utf-8'
+    encoding='utf-8',
+    enqueue=True
 )
@@ -1,18 +1,245 @@
-import json
-from datetime import datetime
-from typing import Any
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Iterator
 
+import orjson
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: блокировка файла недоступна, пишет один процесс
+    fcntl = None
+
+from app.utils.cache import fingerprint
 from app.utils.logging import logger
+from app.utils.urls import normalize_url
+
+# ключи сохранённых URL по файлу: читаем файл один раз за процесс,
+# дальше только дополняем множество при записи
+_DEDUP_CACHE: dict[str, set[int]] = {}
+# сохранения идут из рабочих потоков, не из event loop
+_DEDUP_LOCK = threading.Lock()
+
+# (секунда, ISO-строка) последней метки времени — одна пара,
+# чтобы потоки не увидели секунду от одной метки, а строку от другой
+_LAST_TS: tuple[int, str] = (0, '')
+
+
+def _now_iso() -> str:
+    '''Текущее время UTC (ISO, до секунд); строка кэшируется на секунду.'''
+    global _LAST_TS
+    sec = int(time.time())
+    last_sec, iso = _LAST_TS
+    if sec != last_sec:
+        iso = datetime.fromtimestamp(sec, timezone.utc).isoformat()
+        _LAST_TS = (sec, iso)
+    return iso
+
+
+def _s(value: Any) -> str:
+    '''Строка без краевых пробелов; не строка — пустая строка.'''
+    if not isinstance(value, str):
+        return ''
+    # обычно поле уже чистое — лишнюю копию не создаём
+    if value and (value[0].isspace() or value[-1].isspace()):
+        return value.strip()
+    return value
+
+
+def load_all(path: str = 'results.jsonl') -> Iterator[dict]:
+    '''
+    Потоково читает сохранённые результаты (JSONL, одна запись в строке).
+    Битые строки пропускаются.
+    '''
+    try:
+        # orjson разбирает UTF-8 байты напрямую, без декодирования строк
+        with open(path, 'rb') as f:
+            for line_no, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    logger.warning(
+                        'Файл {}: битая строка {}, пропускаем',
+                        path,
+                        line_no
+                        )
+    except FileNotFoundError:
+        return
+
+
+def _append_records(path: str, records: list[dict]) -> None:
+    '''Дописывает записи в конец JSONL-файла одной операцией.'''
+    if not records:
+        return
+    # весь пакет кодируем заранее и пишем одним write()
+    payload = b''.join(orjson.dumps(rec) + b'\n' for rec in records)
+    with open(path, 'ab') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(payload)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _migrate_legacy_json(jsonl_path: str) -> None:
+    '''
+    Однократно переносит старый results.json (JSON-список) в JSONL.
+    Старый файл переименовывается в *.json.migrated.
+    '''
+    root, ext = os.path.splitext(jsonl_path)
+    legacy_path = root + '.json'
+    if ext != '.jsonl' or not os.path.exists(legacy_path):
+        return
+
+    try:
+        with open(legacy_path, 'rb') as f:
+            legacy = orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError) as error:
+        logger.warning(
+            'Не удалось прочитать {} для миграции: {}',
+            legacy_path,
+            error
+            )
+        return
+
+    if not isinstance(legacy, list):
+        legacy = []
+    records = [rec for rec in legacy if isinstance(rec, dict)]
+    _append_records(jsonl_path, records)
+    os.replace(legacy_path, legacy_path + '.migrated')
+    logger.info(
+        'Миграция {} -> {}: перенесено {} записей',
+        legacy_path,
+        jsonl_path,
+        len(records)
+        )
+
+
+def _parse(
+    results: Any,
+    max_items: int,
+    already_enriched: bool
+) -> list[tuple[str, str, str]]:
+    '''
+    Приводит результаты поиска к списку кортежей (url, title, description).
+    Enriched-элементы — словари с 'snippet', сырые — JSON (str или bytes,
+    разбирается без перекодирования) или словари с 'description'.
+    '''
+    kind = 'enriched-элементов' if already_enriched else 'сырых элементов'
+    if not isinstance(results, list):
+        logger.warning(
+            'Ожидался список {}, получено: {!r}',
+            kind,
+            type(results)
+            )
+        return []
+
+    logger.info('Получено {} {}, берём первые {}',
+                len(results), kind, min(len(results), max_items))
+    desc_key = 'snippet' if already_enriched else 'description'
+    items = []
+    for index, element in enumerate(results[:max_items], start=1):
+        if isinstance(element, (str, bytes)) and not already_enriched:
+            try:
+                element = orjson.loads(element)
+            except Exception as error:
+                logger.warning(
+                    '[{}] Не удалось распарсить элемент: {}',
+                    index,
+                    error
+                    )
+                continue
+        if not isinstance(element, dict):
+            logger.warning(
+                '[{}] Элемент не словарь: {!r}',
+                index,
+                type(element)
+                )
+            continue
+        # промежуточный словарь не нужен — запись соберётся в _persist
+        items.append((
+            _s(element.get('url')),
+            _s(element.get('title')),
+            _s(element.get(desc_key)),
+        ))
+    return items
+
+
+def _existing_urls(path: str) -> set[int]:
+    '''
+    Множество ключей уже сохранённых URL (вызывать под _DEDUP_LOCK).
+    Файл читается потоково при первом обращении, затем берётся из кэша.
+    '''
+    urls = _DEDUP_CACHE.get(path)
+    if urls is None:
+        _migrate_legacy_json(path)
+        # каждый исторический URL хэшируется ровно один раз — здесь;
+        # пустые ключи не храним
+        urls = set()
+        for rec in load_all(path):
+            if isinstance(rec, dict):
+                url = _s(rec.get('url'))
+                if url:
+                    urls.add(fingerprint(normalize_url(url)))
+        _DEDUP_CACHE[path] = urls
+    return urls
+
+
+def _persist(
+    query: str,
+    items: list[tuple[str, str, str]],
+    output_file: str,
+    now: str
+) -> tuple[int, int]:
+    '''
+    Дописывает в файл записи с новыми URL.
+    Возвращает (добавлено, всего уникальных URL).
+    '''
+    with _DEDUP_LOCK:
+        existing_urls = _existing_urls(output_file)
+        # новые записи — только их и дописываем в конец файла
+        new_records = []
+        new_keys: set[int] = set()
+        for index, (url, title, description) in enumerate(items, start=1):
+            url_key = fingerprint(normalize_url(url)) if url else None
+            duplicate = url_key in existing_urls or url_key in new_keys
+            if url_key is None or duplicate:
+                logger.info(
+                    '[{}] Пропуск (дубликат или пустой URL): {!r}',
+                    index,
+                    url
+                    )
+                continue
+            new_records.append({
+                'query': query,
+                'date': now,
+                'title': title or url,
+                'description': description,
+                'url': url
+            })
+            new_keys.add(url_key)
+
+        _append_records(output_file, new_records)
+        # кэш дополняем только после успешной записи
+        existing_urls |= new_keys
+        return len(new_records), len(existing_urls)
 
 
 def save_search_results(
     query: str,
     results: Any,
-    output_file: str = 'results.json',
+    output_file: str = 'results.jsonl',
     max_items: int = 5,
     already_enriched: bool = False
 ) -> int:
-    now = datetime.now().isoformat(timespec='seconds')
+    now = _now_iso()
 
     logger.info(
         '💾 Сохранение результатов поиска: query={!r}, '
@@ -20,115 +247,13 @@ def save_search_results(
         query, max_items, output_file, already_enriched
     )
 
-    # читаем существующие данные
-    try:
-        with open(output_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            if not isinstance(data, list):
-                logger.warning(
-                    'Файл {} не является списком, перезаписываем',
-                    output_file
-                    )
-                data = []
-    except FileNotFoundError:
-        logger.info('Файл {} не найден, создаём новый', output_file)
-        data = []
-    except json.JSONDecodeError:
-        logger.warning(
-            'Файл {} повреждён или пустой, перезаписываем',
-            output_file
-            )
-        data = []
-
-    # множество уже существующих ключей для дедупа
-    existing_urls = {
-        (rec.get('url') or '').strip().lower()
-        for rec in data if isinstance(rec, dict)
-    }
-
-    added = 0
-
-    if already_enriched:
-        # ожидаем список словарей {'url','title','snippet'}
-        if isinstance(results, list):
-            logger.info('Получено {} enriched-элементов, берём первые {}',
-                        len(results), min(len(results), max_items))
-            for index, element in enumerate(results[:max_items], start=1):
-                url = (element.get('url') or '').strip()
-                url_key = url.lower()
-                if not url or url_key in existing_urls:
-                    logger.info(
-                        '[{}] Пропуск (дубликат или пустой URL): {!r}',
-                        index,
-                        url
-                        )
-                    continue
-                title = (element.get('title') or '').strip() or url
-                description = (element.get('snippet') or '').strip()
-                data.append({
-                    'query': query,
-                    'date': now,
-                    'title': title,
-                    'description': description,
-                    'url': url
-                })
-                existing_urls.add(url_key)
-                added += 1
-        else:
-            logger.warning(
-                'Ожидался список enriched-элементов, получено: {!r}',
-                type(results)
-                )
-    else:
-        # сырой список (строки JSON или словари)
-        if isinstance(results, list):
-            logger.info('Получено {} результатов, берём первые {}',
-                        len(results), min(len(results), max_items))
-            for index, element in enumerate(results[:max_items], start=1):
-                try:
-                    data_el = (
-                        json.loads(element) if isinstance(element, str)
-                        else element
-                        )
-                except Exception as error:
-                    logger.warning(
-                        '[{}] Не удалось распарсить элемент: {}',
-                        index,
-                        error
-                        )
-                    continue
-                url = (data_el.get('url') or '').strip()
-                url_key = url.lower()
-                if not url or url_key in existing_urls:
-                    logger.info(
-                        '[{}] Пропуск (дубликат или пустой URL): {!r}',
-                        index,
-                        url
-                        )
-                    continue
-                title = (data_el.get('title') or '').strip() or url
-                description = (data_el.get('description') or '').strip()
-                data.append({
-                    'query': query,
-                    'date': now,
-                    'title': title,
-                    'description': description,
-                    'url': url
-                })
-                existing_urls.add(url_key)
-                added += 1
-        else:
-            logger.warning(
-                'Ожидался список сырых элементов, получено: {!r}',
-                type(results)
-                )
-
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    # разбор без I/O, затем одна запись в файл
+    items = _parse(results, max_items, already_enriched)
+    added, total = _persist(query, items, output_file, now)
 
     logger.info(
         'Успешно добавлено {} новых записей (после дедупа). Всего: {}',
         added,
-        len(data)
+        total
         )
     return added
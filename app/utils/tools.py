@@ -1,11 +1,25 @@
-import json
-from typing import Any, Callable, Optional, Dict
+import asyncio
+import functools
+import re
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import Any, Optional, Dict
 
+import orjson
 from langchain_core.callbacks import BaseCallbackHandler
 from langchain.tools import StructuredTool
 from pydantic import BaseModel, Field
 
+from app.utils.cache import TTLCache, fingerprint
 from app.utils.constants import (
+    CONTEXT_CACHE_MAX_ITEMS,
+    MAX_ITEMS,
+    RICH_DESC_MIN_CHARS,
+    SEARCH_CACHE_MAX_ITEMS,
+    SEARCH_CACHE_TTL,
     SNIPPET_MAX_CHARS,
     TRANFILATURA_MAX_CHARS,
 )
@@ -14,6 +28,89 @@ from app.utils.logging import logger
 from app.utils.storage import save_search_results
 
 
+# Классификация MCP-инструментов по имени одним вызовом regex.
+# Ключевые слова поиска приоритетнее: они проверяются lookahead'ом
+# от начала строки, поэтому 'read_web_page' — это поиск, а не файлы.
+_TOOL_RE = re.compile(
+    r'^(?=.*?(?P<search>search|brave|web))'
+    r'|(?P<fs>read|write|file|directory|move|create)',
+    re.IGNORECASE | re.DOTALL,
+)
+
+_SOURCES_HEADER = (
+    '### Источники (обогащены Trafilatura — используй при ответе):\n'
+)
+# поля подставляются прямо из словарей enriched
+_SOURCE_TEMPLATE = '- [{title}]({url})\n  {snippet}'
+
+# фоновые сохранения: держим ссылки, чтобы задачи не собрал GC;
+# один поток пишет файл по очереди, не занимая пул asyncio по умолчанию
+_BACKGROUND_TASKS: set[asyncio.Task] = set()
+_SAVE_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix='save')
+
+
+@dataclass
+class SearchTurn:
+    '''
+    Состояние поиска в рамках одного сообщения пользователя.
+    Хранится в contextvar, поэтому параллельные диалоги не смешиваются.
+    '''
+    raw_user_input: Optional[str] = None
+    called_queries: Dict[str, set[int]] = field(
+        default_factory=lambda: defaultdict(set)
+    )
+    call_counts: Dict[str, int] = field(
+        default_factory=lambda: defaultdict(int)
+    )
+
+
+current_search_turn: ContextVar[Optional[SearchTurn]] = ContextVar(
+    'current_search_turn',
+    default=None,
+)
+
+
+def _query_cache_key(query: str) -> str:
+    '''
+    Ключ кэша поиска: запрос без учёта регистра, лишних пробелов
+    и завершающих знаков конца предложения. Остальные символы значимы:
+    «что такое C++», «что такое C#» и «погода -10» — разные ключи.
+    '''
+    return ' '.join(query.lower().split()).rstrip('.?!… ')
+
+
+def _bulk_loads(elements: list) -> Optional[list]:
+    '''
+    Разбирает список JSON-строк одним вызовом orjson.
+    None — если элементы не строки или не каждый из них объект JSON
+    (тогда разбираем поштучно, пропуская битые).
+    '''
+    if not all(isinstance(e, str) for e in elements):
+        return None
+    try:
+        data = orjson.loads('[' + ','.join(elements) + ']')
+    except orjson.JSONDecodeError:
+        return None
+    if len(data) != len(elements) or not all(
+        isinstance(d, dict) for d in data
+    ):
+        return None
+    return data
+
+
+@functools.lru_cache(maxsize=256)
+def classify_tool(name: Optional[str]) -> Optional[str]:
+    '''
+    Категория MCP-инструмента по имени: 'search' (веб-поиск),
+    'fs' (файловая система) или None.
+    Набор имён инструментов мал, поэтому результат кэшируется.
+    '''
+    match = _TOOL_RE.search(name or '')
+    if match is None:
+        return None
+    return 'search' if match.group('search') else 'fs'
+
+
 class SearchLoggingCallback(BaseCallbackHandler):
     '''
     Логирует входные данные инструментов поиска (например, brave-search).
@@ -21,7 +118,12 @@ class SearchLoggingCallback(BaseCallbackHandler):
 
     def on_tool_start(self, serialized, input_str, **kwargs):
         # serialized содержит метаданные инструмента (name/description и пр.)
-        tool_name = (serialized or {}).get('name', '').lower()
+        tool_name = (serialized or {}).get('name') or ''
+
+        # логируем только поиск; регистр учитывает classify_tool,
+        # запрос разбираем лишь для поисковых инструментов
+        if not tool_name or classify_tool(tool_name) != 'search':
+            return
 
         # input_str в LC 0.2 бывает и dict, и str — поддержим оба варианта
         if isinstance(input_str, dict):
@@ -33,32 +135,63 @@ class SearchLoggingCallback(BaseCallbackHandler):
         else:
             query_text = str(input_str)
 
-        # логируем всё, что связано с поиском
-        if any(opt in tool_name for opt in ['search', 'brave', 'web']):
-            logger.info(
-                '🔎 [ПОИСК] Инструмент: {} | Запрос: {!r}',
-                tool_name,
-                query_text,
-            )
+        logger.info(
+            '🔎 [ПОИСК] Инструмент: {} | Запрос: {!r}',
+            tool_name,
+            query_text,
+        )
+
+
+async def _save_enriched(query: str, enriched: list[dict]) -> int:
+    return await asyncio.get_running_loop().run_in_executor(
+        _SAVE_POOL,
+        functools.partial(
+            save_search_results,
+            query,
+            enriched,
+            already_enriched=True,
+        ),
+    )
+
+
+def _on_save_done(task: asyncio.Task) -> None:
+    _BACKGROUND_TASKS.discard(task)
+    if task.cancelled():
+        return
+    error = task.exception()
+    if error is not None:
+        logger.warning(
+            'Не удалось сохранить enriched-результаты: {}',
+            error,
+        )
+    else:
+        logger.info('💾 Сохранено enriched-результатов: {}', task.result())
+
+
+def _save_in_background(query: str, enriched: list[dict]) -> None:
+    task = asyncio.create_task(_save_enriched(query, enriched))
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_on_save_done)
 
 
 def wrap_search_tool(
     orig_tool,
-    get_raw_user_input: Callable[[], Optional[str]],
     *,
     max_calls_per_message: int = 1,
 ):
     '''
     Обёртка поискового инструмента:
     - подменяет kwargs['query'] на сырое сообщение пользователя,
-    - предотвращает зацикливание,
+    - предотвращает зацикливание (состояние — в current_search_turn),
     - обогащает результаты Trafilatura и возвращает Markdown-контекст,
-    - логирует и сохраняет JSON.
+    - логирует и сохраняет JSON,
+    - кэширует готовый контекст по нормализованному запросу
+      и по набору URL выдачи.
     '''
 
-    called_queries: set[str] = set()
-    call_count: int = 0
-    last_seen_raw: Optional[str] = None
+    search_cache = TTLCache(SEARCH_CACHE_MAX_ITEMS, SEARCH_CACHE_TTL)
+    # разные формулировки часто дают те же ссылки — контекст общий
+    context_cache = TTLCache(CONTEXT_CACHE_MAX_ITEMS, SEARCH_CACHE_TTL)
 
     class _Args(BaseModel):
         query: str = Field(description='Search query string')
@@ -66,134 +199,192 @@ def wrap_search_tool(
         # pydantic v2
         model_config = {'extra': 'allow'}
 
+    tool_name = orig_tool.name
+
+    # элементы результата — JSON-строки или уже словари (None — не знаем)
+    items_are_json: Optional[bool] = None
+
     async def _acall(**kwargs: Dict[str, Any]) -> Any:
-        nonlocal call_count, called_queries, last_seen_raw
+        nonlocal items_are_json
 
-        raw = get_raw_user_input()
+        turn = current_search_turn.get()
+        if turn is None:
+            # вызов вне process_message — без общего состояния
+            turn = SearchTurn()
+        raw = turn.raw_user_input
+        called_queries = turn.called_queries[tool_name]
 
-        # сброс контекста при новом пользовательском сообщении
-        if raw != last_seen_raw:
-            called_queries = set()
-            call_count = 0
-            last_seen_raw = raw
+        # анти-петля до любых логов и правок kwargs: заблокированный
+        # вызов ничего не форматирует. Сначала дешёвая проверка лимита
+        if turn.call_counts[tool_name] >= max_calls_per_message:
+            return (
+                'Достигнут лимит поисковых запросов для этого сообщения; '
+                'сформируй ответ по уже найденным источникам.'
+            )
+        # проверяем тот запрос, который реально уйдёт в поиск
+        query = raw or kwargs.get('query') or ''
+        qnorm = fingerprint(query.strip().lower())
+        if qnorm in called_queries:
+            return (
+                'Поиск уже выполнен по этому же запросу; '
+                'используй найденные источники ниже.'
+            )
+        called_queries.add(qnorm)
+        turn.call_counts[tool_name] += 1
 
         # лог до правки
         try:
             logger.info(
                 '🔎 [ПОИСК] До правки | tool={} | input={!r}',
-                orig_tool.name,
+                tool_name,
                 kwargs,
             )
         except Exception:
             pass
 
         # всегда подставляем полный исходный текст пользователя
-        if raw:
-            kwargs = {**kwargs, 'query': raw}
+        query_overridden = bool(raw) and kwargs.get('query') != raw
+        if query_overridden:
+            kwargs['query'] = raw
 
-        # анти-петля
-        qnorm = (kwargs.get('query') or '').strip().lower()
-        if qnorm in called_queries:
-            return (
-                'Поиск уже выполнен по этому же запросу; '
-                'используй найденные источники ниже.'
-            )
-        if call_count >= max_calls_per_message:
-            return (
-                'Достигнут лимит поисковых запросов для этого сообщения; '
-                'сформируй ответ по уже найденным источникам.'
-            )
-        called_queries.add(qnorm)
-        call_count += 1
+        # лог после правки (если запрос действительно подменён)
+        if query_overridden:
+            try:
+                logger.info(
+                    '🔎 [ПОИСК] После правки | tool={} | input={!r}',
+                    tool_name,
+                    kwargs,
+                )
+            except Exception:
+                pass
 
-        # лог после правки
-        try:
+        # повторный запрос — отдаём готовый контекст без поиска и Trafilatura
+        cache_key = _query_cache_key(query)
+        cached_md = search_cache.get(cache_key) if cache_key else None
+        if cached_md is not None:
             logger.info(
-                '🔎 [ПОИСК] После правки | tool={} | input={!r}',
-                orig_tool.name,
-                kwargs,
+                '🔎 [ПОИСК] Кэш | tool={} | query={!r}',
+                tool_name,
+                query,
             )
-        except Exception:
-            pass
+            return cached_md
 
         # вызываем оригинальный MCP-инструмент
         result = await orig_tool.ainvoke(kwargs)
 
         # --- ОБОГАЩЕНИЕ ДЛЯ КОНТЕКСТА МОДЕЛИ ---
-        enriched = []
-        if isinstance(result, list):
-            for item, element in enumerate(result, start=1):
-                if len(enriched) >= 5:
+        # 1) разбираем результаты поиска (не больше MAX_ITEMS)
+        parsed = []
+        if isinstance(result, list) and result:
+            # формат элементов у MCP-инструмента обычно стабилен —
+            # проверяем раз, чтобы решить, пробовать ли разбор пачкой
+            if items_are_json is None:
+                items_are_json = isinstance(result[0], (str, bytes))
+            bulk = _bulk_loads(result[:MAX_ITEMS]) if items_are_json else None
+            if bulk is not None:
+                # весь срез разобран одним вызовом — дальше словари
+                result = bulk
+            # битые элементы пропускаем, но разбираем не больше
+            # удвоенного лимита, сколько бы ни вернул поиск
+            candidates = islice(result, MAX_ITEMS * 2)
+            for item, element in enumerate(candidates, start=1):
+                if len(parsed) >= MAX_ITEMS:
                     break
-                try:
-                    data = (
-                        json.loads(element)
-                        if isinstance(element, str)
-                        else element
-                    )
-                except Exception as error:
+                # проба формата — лишь быстрый путь: элемент не того
+                # типа разбираем по isinstance, а не роняем вызов
+                if bulk is None and isinstance(element, (str, bytes)):
+                    try:
+                        data = orjson.loads(element)
+                    except Exception as error:
+                        logger.warning(
+                            '[{}] Не удалось распарсить элемент: {}',
+                            item,
+                            error,
+                        )
+                        continue
+                else:
+                    data = element
+                if not isinstance(data, dict):
                     logger.warning(
-                        '[{}] Не удалось распарсить элемент: {}',
+                        '[{}] Элемент не словарь: {!r}',
                         item,
-                        error,
+                        type(data),
                     )
                     continue
 
                 url = (data.get('url') or '').strip()
                 title = (data.get('title') or '').strip()
                 desc = (data.get('description') or '').strip()
+                parsed.append((url, title, desc))
+
+        # та же выдача уже обогащалась — без Trafilatura и сборки
+        urls_key = tuple(sorted(url for url, _, _ in parsed))
+        cached_md = context_cache.get(urls_key) if parsed else None
+        if cached_md is not None:
+            logger.info(
+                '🔎 [ПОИСК] Кэш по URL | tool={} | query={!r}',
+                tool_name,
+                query,
+            )
+            if cache_key:
+                search_cache.set(cache_key, cached_md)
+            return cached_md
 
-                logger.info('[{}] Trafilatura для {}', item, url or '<no-url>')
+        # 2) Trafilatura по всем URL параллельно (сетевой I/O;
+        #    общий лимит одновременных загрузок — в content.py)
+        async def _fetch(index: int, url: str, desc: str) -> str:
+            logger.info('[{}] Trafilatura для {}', index, url or '<no-url>')
+            # пытаемся вытащить текст; если пусто — берём исходный
+            # desc, а длинный и полный desc используем без загрузки
+            return await fetch_desc_trafilatura(
+                url,
+                fallback_text=desc,
+                max_chars=TRANFILATURA_MAX_CHARS,
+                rich_fallback_chars=min(
+                    SNIPPET_MAX_CHARS, RICH_DESC_MIN_CHARS
+                ),
+            )
 
-                # всегда пытаемся вытащить текст;
-                # если пусто — берём исходный desc
-                summary = fetch_desc_trafilatura(
-                    url,
-                    fallback_text=desc,
-                    max_chars=TRANFILATURA_MAX_CHARS,
-                )
+        summaries = await asyncio.gather(
+            *(
+                _fetch(index, url, desc)
+                for index, (url, _, desc) in enumerate(parsed, start=1)
+            ),
+            return_exceptions=True,
+        )
 
-                snippet = summary.replace('\n', ' ').strip()
-                low = snippet.lower()
-                if (
-                    'подтвердите, что запросы отправляли вы' in low
-                    or 'captcha' in low
-                ):
-                    snippet = (desc or '').replace('\n', ' ').strip()
-                snippet = snippet[:SNIPPET_MAX_CHARS] + '...'
-
-                enriched.append(
-                    {
-                        'url': url,
-                        'title': title or url,
-                        'snippet': snippet,
-                    }
+        # 3) собираем enriched в исходном порядке
+        enriched = []
+        for (url, title, desc), summary in zip(parsed, summaries):
+            if isinstance(summary, BaseException):
+                logger.warning(
+                    'Trafilatura упала для {}: {}', url, summary
                 )
+                summary = desc
 
-        # сохраняем ТОЛЬКО enriched в JSON
-        try:
-            saved = save_search_results(
-                kwargs.get('query', ''),
-                enriched,
-                already_enriched=True,
-            )
-            logger.info('💾 Сохранено enriched-результатов: {}', saved)
-        except Exception as e:
-            logger.warning(
-                'Не удалось сохранить enriched-результаты: {}',
-                e,
+            # страницы-капчи отсекаются в fetch_desc_trafilatura
+            snippet = summary.replace('\n', ' ').strip()
+            snippet = snippet[:SNIPPET_MAX_CHARS] + '...'
+
+            enriched.append(
+                {
+                    'url': url,
+                    'title': title or url,
+                    'snippet': snippet,
+                }
             )
 
+        # сохраняем ТОЛЬКО enriched в JSON — в фоне, не задерживая ответ
+        _save_in_background(query, enriched)
+
         # собираем markdown-контекст для модели
         if enriched:
-            lines = [
-                '### Источники (обогащены Trafilatura — используй при ответе):'
-            ]
-            for source in enriched:
-                lines.append(f'- [{source["title"]}]({source["url"]})')
-                lines.append(f'  {source["snippet"]}')
-                lines.append('')
-            context_md = '\n'.join(lines)
+            context_md = _SOURCES_HEADER + '\n\n'.join(
+                map(_SOURCE_TEMPLATE.format_map, enriched)
+            )
+            if cache_key:
+                search_cache.set(cache_key, context_md)
+            context_cache.set(urls_key, context_md)
         else:
             context_md = (
                 'Не удалось обогатить результаты; '
@@ -0,0 +1,27 @@
+from urllib.parse import urlsplit, urlunsplit
+
+
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url: str) -> str:
+    '''
+    Каноническая форма URL для дедупа и кэшей: схема и хост в нижнем
+    регистре, без порта по умолчанию, без фрагмента и завершающего '/'.
+    Путь и query сохраняются как есть (они чувствительны к регистру).
+    '''
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        # некорректный порт или IPv6-адрес — сравниваем как есть
+        return url
+    scheme = parts.scheme.lower()
+    host = parts.hostname or ''
+    if ':' in host:
+        host = f'[{host}]'
+    if port is not None and port != _DEFAULT_PORTS.get(scheme):
+        host = f'{host}:{port}'
+    path = parts.path.rstrip('/')
+    return urlunsplit((scheme, host, path, parts.query, ''))
@@ -1,4 +1,5 @@
 import os
+from dataclasses import make_dataclass
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -11,6 +12,8 @@ class Config(BaseSettings):
     MODEL_PROVIDER: str = 'openai'
     ANSWER_MAX_TOKENS: int = 1024
     TEMPERATURE: float = 0.0
+    # максимум шагов графа агента на одно сообщение
+    RECURSION_LIMIT: int = 8
 
     FILESYSTEM_PATH: str = '/Users/alexeyfilichkin/MainDev/web_search_agent'
 
@@ -22,4 +25,13 @@ class Config(BaseSettings):
     )
 
 
-settings = Config()
+# после однократной валидации храним значения в замороженном
+# dataclass со слотами: чтение атрибутов без дескрипторов pydantic
+Settings = make_dataclass(
+    'Settings',
+    [(name, field.annotation) for name, field in Config.model_fields.items()],
+    frozen=True,
+    slots=True,
+)
+
+settings = Settings(**Config().model_dump())